@@ -1,141 +1,445 @@
-import os, re, json, html, shutil, subprocess, tempfile, glob
-from urllib.parse import urlparse, parse_qs
-from typing import Dict, List, Optional, Tuple
+import os, re, json, html, shutil, subprocess, tempfile, glob, time, hashlib, functools, inspect, threading, uuid
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse
+from xml.etree.ElementTree import ParseError
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from flask import Flask, request, render_template_string, send_from_directory, abort, url_for
-from jinja2 import Template
-from youtube_transcript_api import YouTubeTranscriptApi
+from flask import (Flask, request, send_from_directory, abort, url_for,
+                   jsonify, copy_current_request_context)
+from jinja2 import Environment, DictLoader
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import json_repair
 
 # ───────────────────────── ENV ─────────────────────────
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")  # vision-capable
+# SDK-level retries on 408/409/429/5xx and connection errors (exponential backoff, honours Retry-After)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
 OUT_DIR = os.getenv("OUT_DIR", "out")
 os.makedirs(OUT_DIR, exist_ok=True)
+# Caches and job status sit beside OUT_DIR, never in it: /out/<path> serves all of OUT_DIR
+STATE_DIR = os.path.realpath(os.getenv("STATE_DIR")
+                             or os.path.join(os.path.dirname(os.path.realpath(OUT_DIR)), "state"))
+if os.path.commonpath([STATE_DIR, os.path.realpath(OUT_DIR)]) == os.path.realpath(OUT_DIR):
+    raise RuntimeError(f"STATE_DIR ({STATE_DIR}) must not be inside OUT_DIR; /out/ would serve it.")
 
 # Optional web search keys (helpful but not required)
 BING_SEARCH_KEY      = os.getenv("BING_SEARCH_KEY", "")
 BING_SEARCH_ENDPOINT = os.getenv("BING_SEARCH_ENDPOINT", "https://api.bing.microsoft.com/v7.0/search")
 SERPAPI_KEY          = os.getenv("SERPAPI_KEY", "")
 
+# Optional YouTube Data API v3 key for title/channel (oembed is used without it)
+YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY", "")
+
+# On-disk fetch cache: oembed/transcripts 7 days, search + page reads 1 day
+CACHE_DIR = os.path.join(STATE_DIR, "cache")
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(7 * 86400)))
+WEB_CACHE_TTL = int(os.getenv("WEB_CACHE_TTL", "86400"))  # search results + page reads
+CACHE_PRUNE_EVERY = float(os.getenv("CACHE_PRUNE_EVERY", "3600"))  # seconds between expired-file sweeps
+PAGE_MEM_BYTES = int(os.getenv("PAGE_MEM_BYTES", str(8 * 1024 * 1024)))  # in-process page tier, per worker
+
+# Opt-in LLM response cache keyed by prompt hash (LLM_CACHE=1)
+LLM_CACHE = os.getenv("LLM_CACHE", "") == "1"
+LLM_CACHE_DIR = os.path.join(STATE_DIR, "llm_cache")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 86400)))
+
+# Route completions through the Batch API (~50% cheaper, slow; offline runs only)
+BATCH_MODE      = os.getenv("BATCH_MODE", "") == "1"
+BATCH_POLL_SECS = float(os.getenv("BATCH_POLL_SECS", "15"))
+BATCH_MAX_WAIT  = float(os.getenv("BATCH_MAX_WAIT", str(24 * 3600)))
+
+# Background /generate jobs per worker process; status lives in STATE_DIR/jobs so any
+# gunicorn worker can answer the poll
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOBS_DIR = os.path.join(STATE_DIR, "jobs")
+
+# Longest Retry-After (seconds) an outbound GET will wait before its retry
+RETRY_AFTER_MAX = float(os.getenv("RETRY_AFTER_MAX", "5"))
+
+# Most videos one /generate_batch request may queue
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "10"))
+
+# Most jobs one worker process holds (queued + running); past it /generate and
+# /generate_batch answer 503
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", str(max(5 * JOB_WORKERS, BATCH_MAX_URLS))))
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", "60"))  # seconds, sent with that 503
+
 app = Flask(__name__)
 
+# ───────────────────── HTTP session ────────────────────
+# One pooled keep-alive session for every outbound GET (oembed, search, Jina, pages)
+_SESSION = requests.Session()
+class _CappedRetry(Retry):
+    """Honours Retry-After on 429/503, but never parks a request thread for long."""
+    def get_retry_after(self, response):
+        after = super().get_retry_after(response)
+        return None if after is None else min(after, RETRY_AFTER_MAX)
+
+# Transient rate limits and gateway errors get two quick retries instead of failing
+# the fetch; raise_on_status=False hands back the last response so callers see it as before.
+# Read timeouts are not retried (a hung upstream would cost 3x its timeout) and a
+# refused connection only once.
+_RETRY = _CappedRetry(total=2, connect=1, read=0, backoff_factor=0.3,
+                      status_forcelist=(429, 502, 503, 504),
+                      respect_retry_after_header=True, raise_on_status=False)
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=_RETRY)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
 # ───────────────────── OpenAI client ───────────────────
-from openai import OpenAI
+@functools.lru_cache(maxsize=1)
 def _llm():
-    return OpenAI()  # uses OPENAI_API_KEY
+    from openai import OpenAI  # deferred: keeps /health and worker boot fast
+    return OpenAI(max_retries=OPENAI_MAX_RETRIES)  # uses OPENAI_API_KEY; shared so its connection pool is reused
 
 # ────────────────────── Utilities ──────────────────────
+_SAFE_TOKEN_RE = re.compile(r"[^A-Za-z0-9_\-]")
+_WS_RE = re.compile(r"\s+")
+
 def safe_token(s: str) -> str:
     s = (s or "").strip().replace(" ", "_")
-    return re.sub(r"[^A-Za-z0-9_\-]", "", s)
+    return _SAFE_TOKEN_RE.sub("", s)
+
+# watch?v=ID (any query position), youtu.be/ID, /shorts/ID, /embed/ID, /live/ID;
+# anchored to the host (www./m./music. allowed, optional :port) and to a full 11-char
+# id; scheme, host and path match case-insensitively, the id and "v=" do not
+_VIDEO_ID_RE = re.compile(
+    r"(?i:https?://)?(?:[A-Za-z0-9-]+\.)*"
+    r"(?:(?i:youtube\.com)(?::\d+)?/(?:(?i:watch)\?(?:[^#]*&)?v=|(?i:shorts|embed|live)/)"
+    r"|(?i:youtu\.be)(?::\d+)?/)"
+    r"([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])"
+)
 
+@functools.lru_cache(maxsize=1024)
 def video_id_from_url(url: str) -> str:
-    q = urlparse(url)
-    if q.hostname in ("youtu.be",):
-        return q.path.lstrip("/")
-    if q.hostname and "youtube.com" in q.hostname:
-        vid = parse_qs(q.query).get("v", [None])[0]
-        if vid:
-            return vid
+    m = _VIDEO_ID_RE.match((url or "").strip())
+    if m:
+        return m.group(1)
     raise ValueError("Could not extract YouTube video id from URL.")
 
+# ────────────────────── Fetch cache ──────────────────────
+def _write_bytes_atomic(path: str, data: bytes) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _write_json_atomic(path: str, obj) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_bytes_atomic(path, orjson.dumps(obj))
+
+def _read_json(path: str):
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+def _prune_dir(path: str, max_age: float, suffix: str = ".json") -> None:
+    """Deletes files in path ending in suffix that were last written over max_age seconds ago."""
+    cutoff = time.time() - max_age
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                try:
+                    if e.name.endswith(suffix) and e.stat().st_mtime < cutoff:
+                        os.remove(e.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+
+_last_prune: Dict[Tuple[str, str], float] = {}
+_prune_lock = threading.Lock()
+
+def _maybe_prune(path: str, max_age: float, suffix: str = ".json") -> None:
+    """_prune_dir, at most once per CACHE_PRUNE_EVERY for each (path, suffix) in this process."""
+    now = time.time()
+    with _prune_lock:
+        if now - _last_prune.get((path, suffix), 0) < CACHE_PRUNE_EVERY:
+            return
+        _last_prune[(path, suffix)] = now
+    _prune_dir(path, max_age, suffix)
+
+def _worth_caching(val) -> bool:
+    if isinstance(val, dict):
+        return any(val.values())
+    return bool(val)
+
+def cached_fetch(suffix: str, ttl: int = CACHE_TTL, maxsize: int = 512, maxbytes: Optional[int] = None):
+    """
+    Two-tier cache for deterministic fetchers: an in-process LRU in front of
+    STATE_DIR/cache/<key>.<suffix>.json, both expiring after ttl seconds. Empty
+    results are never stored, so a transient network failure is retried on the
+    next call. Pass refresh=True to skip both tiers and overwrite the entry; it
+    is forwarded to fn when fn takes it, so nested cached fetches refresh too.
+    The LRU holds at most maxsize entries and, if given, maxbytes of encoded
+    values; expired files are swept from disk every CACHE_PRUNE_EVERY seconds.
+    """
+    def deco(fn):
+        forward_refresh = "refresh" in inspect.signature(fn).parameters
+        mem: "OrderedDict[str, Tuple[float, object, int]]" = OrderedDict()  # key -> (expires, value, size)
+        mem_bytes = 0
+        lock = threading.Lock()
+
+        @functools.wraps(fn)
+        def wrapper(*args, refresh: bool = False, **kwargs):
+            nonlocal mem_bytes
+            kw = sorted(kwargs.items())
+            key = "_".join([str(a) for a in args] + [f"{k}-{v}" for k, v in kw])
+            if safe_token(key) != key or len(key) > 100:
+                key = hashlib.sha256(repr((fn.__name__, args, kw)).encode("utf-8")).hexdigest()
+            now = time.time()
+            with lock:
+                hit = mem.get(key)
+                if hit is not None and not refresh and hit[0] > now:
+                    mem.move_to_end(key)
+                    return hit[1]
+            path = os.path.join(CACHE_DIR, f"{key}.{suffix}.json")
+            val = None
+            try:
+                expires = os.path.getmtime(path) + ttl
+                if not refresh and expires > now:
+                    val = _read_json(path)
+            except (OSError, ValueError):
+                val = None
+            if val is None:
+                val = fn(*args, **kwargs, **({"refresh": refresh} if forward_refresh else {}))
+                if not _worth_caching(val):
+                    return val
+                expires = time.time() + ttl
+                try:
+                    _write_json_atomic(path, val)
+                except OSError:
+                    pass
+                _maybe_prune(CACHE_DIR, ttl, f".{suffix}.json")
+            size = len(orjson.dumps(val)) if maxbytes else 0
+            with lock:
+                old = mem.pop(key, None)
+                if old is not None:
+                    mem_bytes -= old[2]
+                if maxbytes and size > maxbytes:
+                    return val  # too big for the memory tier; disk still has it
+                mem[key] = (expires, val, size)
+                mem_bytes += size
+                while len(mem) > maxsize or (maxbytes and mem_bytes > maxbytes):
+                    mem_bytes -= mem.popitem(last=False)[1][2]
+            return val
+        return wrapper
+    return deco
+
+def _json_dict(r: requests.Response) -> dict:
+    """r.json() when the body is an object; a list/null/scalar body counts as empty."""
+    j = r.json()
+    return j if isinstance(j, dict) else {}
+
+def _dicts(x) -> List[dict]:
+    return [i for i in x if isinstance(i, dict)] if isinstance(x, list) else []
+
+def _metadata_via_data_api(video_id: str) -> Dict[str, str]:
+    # field mask trims the reply to the two strings we use
+    r = _SESSION.get(
+        "https://www.googleapis.com/youtube/v3/videos",
+        params={"id": video_id, "part": "snippet", "key": YOUTUBE_API_KEY,
+                "fields": "items(snippet(title,channelTitle))"},
+        timeout=10,
+    )
+    if r.ok:
+        items = _dicts(_json_dict(r).get("items"))
+        if items:
+            sn = items[0].get("snippet")
+            if isinstance(sn, dict):
+                return {"title": str(sn.get("title") or ""), "author": str(sn.get("channelTitle") or "")}
+    return {}
+
+@cached_fetch("meta")
 def fetch_basic_metadata(video_id: str) -> Dict[str, str]:
+    if YOUTUBE_API_KEY:
+        try:
+            meta = _metadata_via_data_api(video_id)
+            if meta:
+                return meta
+        except (requests.RequestException, ValueError):
+            pass  # fall through to oembed
     try:
-        r = requests.get(
+        r = _SESSION.get(
             "https://www.youtube.com/oembed",
             params={"url": f"https://www.youtube.com/watch?v={video_id}", "format": "json"},
             timeout=15,
         )
         if r.ok:
-            j = r.json()
-            return {"title": j.get("title", ""), "author": j.get("author_name", "")}
-    except Exception:
+            j = _json_dict(r)
+            return {"title": str(j.get("title") or ""), "author": str(j.get("author_name") or "")}
+    except (requests.RequestException, ValueError):
         pass
     return {"title": "", "author": ""}
 
-def fetch_transcript_text(video_id: str, limit_chars: int = 30000) -> str:
+def iter_transcript_texts(video_id: str) -> Iterator[str]:
+    """Yields non-empty caption texts in order; callers stop pulling once they have enough."""
+    # deferred until a transcript is needed
+    from youtube_transcript_api import YouTubeTranscriptApi, CouldNotRetrieveTranscript
+    # one listing + one fetch; the old get_transcript() fallback re-listed the
+    # video only to look for the same "en" track that had just been missed
     try:
-        trs = YouTubeTranscriptApi.list_transcripts(video_id)
-        try:
-            t = trs.find_transcript(["en", "en-US"]).fetch()
-        except Exception:
-            t = YouTubeTranscriptApi.get_transcript(video_id)
-        buf = " ".join(seg.get("text","") for seg in t if seg.get("text","").strip())
-        return buf[:limit_chars]
-    except Exception:
-        return ""
+        segs = YouTubeTranscriptApi.get_transcript(video_id, languages=("en", "en-US"))
+    except (CouldNotRetrieveTranscript, requests.RequestException, ValueError, ParseError):
+        return  # no usable captions: empty transcript
+    for seg in segs:
+        text = seg.get("text", "")
+        if text.strip():
+            yield text
+
+@cached_fetch("trs")
+def fetch_transcript_text(video_id: str, limit_chars: int = 30000) -> str:
+    # single pass; stop once the budget is filled instead of joining everything and slicing
+    parts: List[str] = []
+    total = 0
+    for text in iter_transcript_texts(video_id):
+        if total + len(text) >= limit_chars:
+            parts.append(text[:limit_chars - total])
+            break
+        parts.append(text)
+        total += len(text) + 1
+    return " ".join(parts)
 
 # ─────────────── Frame extraction (yt-dlp + ffmpeg) ───────────────
-def extract_frames(youtube_url: str, case_id: str, fps: float = 2.0, max_frames: int = 16) -> List[str]:
+# Per-subprocess cap; frames run alongside the other fetches, so one stuck
+# download must not hold the whole request hostage. Timeout => no frames.
+FRAME_STEP_TIMEOUT = float(os.getenv("FRAME_STEP_TIMEOUT", "120"))
+# KEYFRAMES_ONLY=1: decode only I-frames (clean, artifact-free stills, much less decode
+# work) and stride-sample them, instead of sampling at a fixed rate
+KEYFRAMES_ONLY = os.getenv("KEYFRAMES_ONLY", "") == "1"
+# Stills only need a video stream at modest resolution (the vision model downsizes
+# anyway); CLIP_SECONDS > 0 additionally fetches just the opening N seconds
+FRAME_MAX_HEIGHT = int(os.getenv("FRAME_MAX_HEIGHT", "720"))
+CLIP_SECONDS = int(os.getenv("CLIP_SECONDS", "0"))
+# Stills are written as JPEG no wider than this; the vision model tiles at ~768px,
+# so anything larger only inflates what it has to fetch from /frames
+FRAME_MAX_WIDTH = int(os.getenv("FRAME_MAX_WIDTH", "768"))
+
+def _probe_duration(video_path: str) -> Optional[float]:
+    """Container duration in seconds (header read only), or None if ffprobe can't tell."""
+    try:
+        out = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", video_path],
+            check=True, capture_output=True, text=True, timeout=30,
+        ).stdout
+        return float(out.strip()) or None
+    except (subprocess.SubprocessError, OSError, ValueError):
+        return None
+
+def _publish_frames(work: str, frames_dir: str) -> None:
+    """Swap a finished work dir in as frames_dir, so readers see one complete set or the other."""
+    old = f"{frames_dir}.old.{uuid.uuid4().hex}"
+    try:
+        os.rename(frames_dir, old)
+    except FileNotFoundError:
+        old = None
+    try:
+        os.replace(work, frames_dir)
+    except OSError:
+        # another build published between our rename and replace; keep theirs
+        shutil.rmtree(work, ignore_errors=True)
+    if old:
+        shutil.rmtree(old, ignore_errors=True)
+
+def extract_frames(youtube_url: str, case_id: str, fps: float = 2.0, max_frames: int = 16,
+                   refresh: bool = False) -> List[str]:
     """
-    Downloads the video to a temp file (yt-dlp) and extracts PNG frames with ffmpeg.
-    Saves into OUT_DIR/frames/<case_id>/frame_001.png ...
+    Downloads the video to a temp file (yt-dlp) and extracts JPEG frames with ffmpeg.
+    Saves into OUT_DIR/frames/<case_id>/frame_001.jpg ...
     Returns a list of absolute file paths to frames (capped by max_frames).
+    Frames already on disk for this case are reused unless refresh=True.
+    Stills are built in a hidden work dir and swapped in whole, so a failed or
+    concurrent run never leaves (or serves) a partial set.
     """
     frames_dir = os.path.join(OUT_DIR, "frames", case_id)
-    if os.path.isdir(frames_dir):
-        shutil.rmtree(frames_dir)
-    os.makedirs(frames_dir, exist_ok=True)
+    existing = sorted(glob.glob(os.path.join(frames_dir, "frame_*.jpg")))
+    if existing and not refresh:
+        return existing[:max_frames]
+    os.makedirs(os.path.dirname(frames_dir), exist_ok=True)
 
     tmpdir = tempfile.mkdtemp(prefix="grab_")
+    work = tempfile.mkdtemp(prefix=f".{case_id}.", dir=os.path.dirname(frames_dir))
     try:
-        # 1) download best mp4
+        # 1) download a video-only stream (no audio, no merge), height-capped
         video_path = os.path.join(tmpdir, "video.mp4")
+        h = FRAME_MAX_HEIGHT
         cmd_dl = [
             "yt-dlp",
-            "-f", "mp4/bv*+ba/b",   # prefer mp4
+            "-f", f"bv*[height<={h}][ext=mp4]/bv*[height<={h}]/b[height<={h}]/b",   # prefer mp4
             "--no-warnings",
             "--quiet",
             "-o", video_path,
             youtube_url
         ]
-        subprocess.run(cmd_dl, check=True)
+        if CLIP_SECONDS > 0:
+            cmd_dl[1:1] = ["--download-sections", f"*0-{CLIP_SECONDS}"]
+        subprocess.run(cmd_dl, check=True, timeout=FRAME_STEP_TIMEOUT)
 
         # 2) extract frames at fps (capped)
-        # We do two passes: first extract all at fps; then trim to max_frames by skipping
-        raw_pattern = os.path.join(frames_dir, "raw_%06d.png")
-        cmd_ff = [
-            "ffmpeg", "-hide_banner", "-loglevel", "error",
-            "-i", video_path,
-            "-vf", f"fps={fps}",
-            raw_pattern
-        ]
-        subprocess.run(cmd_ff, check=True)
+        # Lower the rate so ffmpeg emits ~max_frames stills over the whole clip instead
+        # of encoding every 0.5s and discarding most; the trim below still applies.
+        raw_pattern = os.path.join(work, "raw_%06d.jpg")
+        scale = f"scale='min({FRAME_MAX_WIDTH},iw)':-2"
+        duration = _probe_duration(video_path)
+        if KEYFRAMES_ONLY:
+            # long videos carry hundreds of I-frames; keep only those at least
+            # duration/max_frames apart and stop encoding once we have enough
+            vf, cap = scale, max_frames * 8
+            if duration:
+                gap = duration / max_frames
+                vf = f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{gap:.3f})',{scale}"
+                cap = max_frames + 1
+            cmd_ff = [
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-skip_frame", "nokey", "-i", video_path,
+                "-vf", vf, "-fps_mode", "vfr", "-frames:v", str(cap), "-q:v", "3",
+                raw_pattern
+            ]
+        else:
+            if duration:
+                fps = min(fps, max_frames / duration)
+            cmd_ff = [
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-i", video_path,
+                "-vf", f"fps={fps:.6f},{scale}", "-q:v", "3",
+                raw_pattern
+            ]
+        subprocess.run(cmd_ff, check=True, timeout=FRAME_STEP_TIMEOUT)
 
         # 3) keep at most max_frames evenly spaced
-        raws = sorted(glob.glob(os.path.join(frames_dir, "raw_*.png")))
+        raws = sorted(glob.glob(os.path.join(work, "raw_*.jpg")))
         if not raws:
             return []
         if len(raws) <= max_frames:
-            # rename to frame_001.png numbering
-            out_files = []
+            # rename to frame_001.jpg numbering
             for i, p in enumerate(raws, start=1):
-                newp = os.path.join(frames_dir, f"frame_{i:03d}.png")
-                os.rename(p, newp)
-                out_files.append(newp)
-            return out_files
-        # pick evenly spaced indices
-        idxs = [int(round(i*(len(raws)-1)/(max_frames-1))) for i in range(max_frames)]
-        picked = []
-        for j, k in enumerate(idxs, start=1):
-            src = raws[k]
-            dst = os.path.join(frames_dir, f"frame_{j:03d}.png")
-            shutil.copy2(src, dst)
-            picked.append(dst)
-        # cleanup raw
-        for p in raws:
-            os.remove(p)
-        return picked
-    except Exception:
+                os.rename(p, os.path.join(work, f"frame_{i:03d}.jpg"))
+        else:
+            # pick evenly spaced indices
+            idxs = [int(round(i*(len(raws)-1)/(max_frames-1))) for i in range(max_frames)]
+            for j, k in enumerate(idxs, start=1):
+                os.replace(raws[k], os.path.join(work, f"frame_{j:03d}.jpg"))
+            # drop the raws that weren't picked
+            for k in set(range(len(raws))) - set(idxs):
+                os.remove(raws[k])
+        _publish_frames(work, frames_dir)
+        return sorted(glob.glob(os.path.join(frames_dir, "frame_*.jpg")))[:max_frames]
+    except (subprocess.SubprocessError, OSError):  # yt-dlp/ffmpeg failed, timed out or missing
         return []
     finally:
         shutil.rmtree(tmpdir, ignore_errors=True)
+        shutil.rmtree(work, ignore_errors=True)
 
 def frame_urls_for_case(case_id: str) -> List[str]:
     """
     Returns Flask URLs for the saved frames so GPT-4o can fetch them.
     """
-    rels = sorted(glob.glob(os.path.join(OUT_DIR, "frames", case_id, "frame_*.png")))
+    rels = sorted(glob.glob(os.path.join(OUT_DIR, "frames", case_id, "frame_*.jpg")))
     urls = []
     for p in rels:
         fname = os.path.basename(p)
@@ -155,51 +459,112 @@ PUBLISHER_WHITELIST = [
     "ispot.tv","adsoftheworld.com","adforum.com","businesswire.com","prnewswire.com"
 ]
 
+# exact domain or any subdomain of it, matched in one pass at the end of the host
+_WHITELIST_RE = re.compile(r"(?:^|\.)(?:" + "|".join(re.escape(d) for d in PUBLISHER_WHITELIST) + r")$")
+
+@functools.lru_cache(maxsize=4096)  # the same URL is checked in web_search and again in enrichment
 def _host_ok(url: str) -> bool:
     try:
         host = urlparse(url).hostname or ""
-        return any(dom in host for dom in PUBLISHER_WHITELIST)
-    except Exception:
+        return bool(_WHITELIST_RE.search(host))
+    except ValueError:  # malformed URL (e.g. a broken IPv6 literal)
         return False
 
-def http_get_readable(url: str, timeout=12) -> str:
+# Only the first few hundred KB of an article ever yield snippets; a multi-MB page
+# is cut off here instead of being materialised whole under concurrent fan-out.
+MAX_PAGE_BYTES = int(os.getenv("MAX_PAGE_BYTES", str(512 * 1024)))
+
+def _read_capped(r: requests.Response) -> str:
+    buf = bytearray()
+    with r:
+        for chunk in r.iter_content(65536):
+            buf += chunk
+            if len(buf) >= MAX_PAGE_BYTES:
+                break
+    try:
+        return buf[:MAX_PAGE_BYTES].decode(r.encoding or "utf-8", errors="replace")
+    except LookupError:  # charset in Content-Type that Python doesn't know
+        return buf[:MAX_PAGE_BYTES].decode("utf-8", errors="replace")
+
+# Shorter reads are consent walls, JS shells or error stubs, from either source
+MIN_PAGE_CHARS = 500
+
+def _get_via_jina(url: str, timeout) -> str:
     try:
-        r = requests.get(f"https://r.jina.ai/{url}", timeout=timeout)
-        if r.ok and len(r.text) > 400:
-            return r.text
-    except Exception:
+        r = _SESSION.get(f"https://r.jina.ai/{url}", timeout=timeout, stream=True)
+        if r.ok:
+            text = _read_capped(r)
+            if len(text) > MIN_PAGE_CHARS:
+                return text
+        r.close()
+    except requests.RequestException:
         pass
+    return ""
+
+def _get_direct(url: str, timeout) -> str:
     try:
-        r = requests.get(url, timeout=timeout, headers={"User-Agent":"Mozilla/5.0"})
+        r = _SESSION.get(url, timeout=timeout, headers={"User-Agent":"Mozilla/5.0"}, stream=True)
         if r.ok:
-            return r.text
-    except Exception:
+            text = _read_capped(r)
+            if len(text) > MIN_PAGE_CHARS:
+                return text
+        r.close()
+    except requests.RequestException:
         pass
     return ""
 
+# A direct GET is only sent when Jina misses, or is still pending after HEDGE_DELAY
+# seconds, so the common path makes a single request. Jina's readable text is
+# preferred over the direct page's raw markup: a direct read that lands first is
+# only used if Jina hasn't answered within a further HEDGE_DELAY.
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "3"))
+
+@cached_fetch("page", ttl=WEB_CACHE_TTL, maxsize=64, maxbytes=PAGE_MEM_BYTES)
+def http_get_readable(url: str, timeout=12) -> str:
+    # A per-call executor keeps a slow read from queueing behind other builds; a
+    # hedged request that loses is left to finish.
+    ex = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge")
+    try:
+        jina = ex.submit(_get_via_jina, url, timeout)
+        done, _ = wait([jina], timeout=HEDGE_DELAY)
+        if done:
+            return jina.result() or _get_direct(url, timeout)
+        direct = ex.submit(_get_direct, url, timeout)
+        done, _ = wait([jina, direct], return_when=FIRST_COMPLETED)
+        if jina in done:
+            return jina.result() or direct.result()
+        wait([jina], timeout=HEDGE_DELAY)  # direct came first: a short grace for Jina
+        if jina.done() and jina.result():
+            return jina.result()
+        return direct.result() or jina.result()
+    finally:
+        ex.shutdown(wait=False)
+
+@cached_fetch("search", ttl=WEB_CACHE_TTL)
 def web_search(query: str, limit: int = 5) -> List[Dict[str,str]]:
     results = []
     try:
         if BING_SEARCH_KEY:
-            r = requests.get(
+            r = _SESSION.get(
                 BING_SEARCH_ENDPOINT,
                 params={"q": query, "count": limit},
                 headers={"Ocp-Apim-Subscription-Key": BING_SEARCH_KEY},
                 timeout=10
             )
             if r.ok:
-                for i in r.json().get("webPages", {}).get("value", []):
-                    results.append({"title": i.get("name",""), "url": i.get("url","")})
+                pages = _json_dict(r).get("webPages")
+                for i in _dicts(pages.get("value") if isinstance(pages, dict) else None):
+                    results.append({"title": str(i.get("name") or ""), "url": str(i.get("url") or "")})
         elif SERPAPI_KEY:
-            r = requests.get(
+            r = _SESSION.get(
                 "https://serpapi.com/search.json",
                 params={"engine":"google","q":query,"num":limit,"api_key":SERPAPI_KEY},
                 timeout=10
             )
             if r.ok:
-                for i in r.json().get("organic_results", []):
-                    results.append({"title": i.get("title",""), "url": i.get("link","")})
-    except Exception:
+                for i in _dicts(_json_dict(r).get("organic_results")):
+                    results.append({"title": str(i.get("title") or ""), "url": str(i.get("link") or "")})
+    except (requests.RequestException, ValueError):
         pass
     dedup, seen = [], set()
     for it in results:
@@ -209,44 +574,47 @@ def web_search(query: str, limit: int = 5) -> List[Dict[str,str]]:
             dedup.append(it); seen.add(u)
     return dedup[:limit]
 
-def enrich_from_trades_for_prompt(title: str) -> Dict[str, List[str]]:
+_SNIPPET_RE = re.compile(r"[^\n\r]{60,240}")
+SNIPPET_KEYWORDS = ("director", "voice", "agency", "super bowl", "spot", "commercial")
+# all keywords in one alternation: a single C-level scan per line instead of N `in` checks
+_SNIPPET_KEYWORD_RE = re.compile("|".join(re.escape(k) for k in SNIPPET_KEYWORDS), re.I)
+
+# Trade titles searched together via one site:-OR query instead of one query each
+TRADE_SEARCH_SITES = ("adweek.com", "adage.com", "shootonline.com")
+
+@cached_fetch("trade", ttl=WEB_CACHE_TTL, maxsize=128)
+def enrich_from_trades_for_prompt(title: str, refresh: bool = False) -> Dict[str, List[str]]:
+    sites = " OR ".join(f"site:{d}" for d in TRADE_SEARCH_SITES)
     queries = [
-        f"{title} Super Bowl ad credits",
-        f"{title} director",
-        f"{title} agency",
-        f"{title} voiceover",
-        f"{title} adweek",
-        f"{title} adage",
-        f"{title} shootonline",
+        (f"{title} Super Bowl ad credits", 3),
+        (f"{title} director agency voiceover", 3),
+        (f"({sites}) {title}", 3 * len(TRADE_SEARCH_SITES)),
     ]
-    pages = []
-    for q in queries:
-        for r in web_search(q, limit=3):
-            u = r.get("url","")
-            if _host_ok(u):
-                pages.append((u, http_get_readable(u)))
+    # searches are independent: run them together, then read each unique page once
+    with ThreadPoolExecutor(max_workers=len(queries)) as ex:
+        hits = list(ex.map(lambda ql: web_search(ql[0], limit=ql[1], refresh=refresh), queries))
+    urls = list(dict.fromkeys(r.get("url","") for rs in hits for r in rs if _host_ok(r.get("url",""))))
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        pages = list(zip(urls, ex.map(lambda u: http_get_readable(u, refresh=refresh), urls)))
     snips, cites = [], []
     for u, t in pages:
         if not t: continue
         # extract short interesting chunks
-        for m in re.finditer(r"([^\n\r]{60,240})", t):
-            s = m.group(1).strip()
-            if any(k in s.lower() for k in ["director","voice","agency","super bowl","spot","commercial"]):
+        for m in _SNIPPET_RE.finditer(t):
+            s = m.group().strip()
+            if _SNIPPET_KEYWORD_RE.search(s):
                 snips.append(s[:240]); cites.append(u)
                 if len(snips) >= 6: break
         if len(snips) >= 6: break
-    # dedupe cites
-    uniq = []
-    for u in cites:
-        if u not in uniq: uniq.append(u)
+    # dedupe cites, first-seen order (dict keys: O(1) membership)
+    uniq = list(dict.fromkeys(cites))
     return {"snippets": snips[:6], "citations": uniq[:6]}
 
 # ───────────── Concrete action enforcement helpers ─────────────
-VAGUE_PAT = re.compile(
-    r"\b(people|family|someone|person|group|crowd|audience|they|friends|consumers|various settings|reacts?|celebrates?)\b",
-    re.I
-)
-MUST_HAVE_VERB = re.compile(r"\b(dunks|rams|spits|howls|upends|flips|dives|crashes|throws|shatters|smashes|screams|yells|jumps|runs|pours|stacks|tears)\b", re.I)
+VAGUE_WORDS = r"people|family|someone|person|group|crowd|audience|they|friends|consumers|various settings|reacts?|celebrates?"
+MUST_HAVE_VERBS = r"dunks|rams|spits|howls|upends|flips|dives|crashes|throws|shatters|smashes|screams|yells|jumps|runs|pours|stacks|tears"
+# One alternation, one scan per description; the named group says which list hit
+VISUAL_WORDS_PAT = re.compile(rf"\b(?:(?P<verb>{MUST_HAVE_VERBS})|(?P<vague>{VAGUE_WORDS}))\b", re.I)
 
 def drop_vague(items: List[Dict]) -> List[Dict]:
     cleaned = []
@@ -255,7 +623,8 @@ def drop_vague(items: List[Dict]) -> List[Dict]:
         prov = (it or {}).get("provenance",[])
         if not desc or "source_verified_visuals" not in prov:
             continue
-        if VAGUE_PAT.search(desc) and not MUST_HAVE_VERB.search(desc):
+        hits = {m.lastgroup for m in VISUAL_WORDS_PAT.finditer(desc)}
+        if "vague" in hits and "verb" not in hits:
             continue
         cleaned.append({"description": desc, "provenance": ["source_verified_visuals"]})
     return cleaned
@@ -298,22 +667,44 @@ OUTPUT JSON (exact shape):
 
 VALIDATION:
 - Every item in visuals_montage_sourced must be visible in at least one provided frame; use “source_verified_visuals”.
+- visuals_montage_sourced must list 8–14 items, each a specific subject + strong verb + object.
+- Never use generic words like “people/family/friends/crowd react” or “celebrates” in visuals.
 - Omit anything uncertain. No wardrobe, names, counts, or props unless clearly visible.
+- Before returning, silently check the item count, the concrete-verb rule, and that every dialog line is a literal substring of the transcript; fix any violation, then output only the final JSON.
 - JSON only. No Markdown.
 """.strip()
 
+# Fallback instruction, only sent when drop_vague() still rejects the first pass.
+# Only the visuals list is read back, so only the visuals list is requested.
+TIGHTEN_PROMPT = """
+Return ONLY a JSON object with the single key 'visuals_montage_sourced'; omit every other key.
+Your 'visuals_montage_sourced' is too vague.
+Rewrite it to list 8–14 concrete on-screen actions that are visible in the provided frames.
+Each item must include a specific subject + strong verb + object (e.g., “woman crashes through window”, “dog howls”, “man upends coffee table”).
+Do NOT use generic words like “people/family/friends react”.
+""".strip()
+
+# 14 short visual items fit comfortably; the full document needs the larger budget
+TIGHTEN_MAX_TOKENS = 700
+
 def vision_payload(frames: List[str], title: str, channel: str, url: str, transcript: str,
                    trade_snips: List[str], trade_urls: List[str]) -> List[dict]:
     parts: List[dict] = []
     for u in frames:
         parts.append({"type":"image_url","image_url":{"url":u}})
+    # Stable per-video content first (frames, meta, transcript) so OpenAI's prompt
+    # cache can reuse the prefix; search-dependent trade snippets go last.
     text = [
         f"Title: {title}",
         f"Channel: {channel}",
         f"URL: {url}",
         "",
+        "Transcript (verbatim):",
+        # pasted transcripts carry caption line breaks and padding that only cost tokens
+        _WS_RE.sub(" ", transcript).strip(),
     ]
     if trade_snips:
+        text.append("")
         text.append("Trade-press snippets (for factual support only; do not invent visuals):")
         for s in trade_snips:
             text.append(f"• {s}")
@@ -321,93 +712,176 @@ def vision_payload(frames: List[str], title: str, channel: str, url: str, transc
             text.append("Links:")
             for lu in trade_urls:
                 text.append(f"- {lu}")
-        text.append("")
-    text.append("Transcript (verbatim):")
-    text.append(transcript)
     parts.append({"type":"text","text":"\n".join(text)})
     return parts
 
-def gpt_json(system_prompt: str, user_payload: List[dict]) -> dict:
-    resp = _llm().chat.completions.create(
+def batch_chat_text(body: dict) -> Tuple[str, Optional[str]]:
+    """
+    Runs one chat completion through the OpenAI Batch API and polls until it
+    resolves; returns the reply and its finish_reason. The call blocks for as long as the batch takes, so only enable
+    BATCH_MODE for queued / offline generations.
+    """
+    client = _llm()
+    line = json.dumps({"custom_id": "case", "method": "POST", "url": "/v1/chat/completions", "body": body},
+                      ensure_ascii=False)
+    upload = client.files.create(file=("batch.jsonl", line.encode("utf-8")), purpose="batch")
+    batch = client.batches.create(input_file_id=upload.id, endpoint="/v1/chat/completions",
+                                  completion_window="24h")
+    deadline = time.time() + BATCH_MAX_WAIT
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        if time.time() > deadline:
+            client.batches.cancel(batch.id)
+            raise RuntimeError(f"Batch {batch.id} did not finish within {int(BATCH_MAX_WAIT)}s.")
+        time.sleep(BATCH_POLL_SECS)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'.")
+    row = json.loads(client.files.content(batch.output_file_id).text.splitlines()[0])
+    choice = row["response"]["body"]["choices"][0]
+    return choice["message"]["content"] or "{}", choice.get("finish_reason")
+
+def chat_text(messages: List[dict], max_tokens: int = 2200, refresh: bool = False) -> str:
+    """
+    Single entry point for JSON-mode chat completions. With LLM_CACHE=1 the raw
+    reply is stored under STATE_DIR/llm_cache/<sha256>.json, keyed on model +
+    messages, so an identical prompt never hits the API twice. Only complete
+    replies that parse to a non-empty object are stored; refresh=True skips the
+    lookup and overwrites the entry.
+    """
+    key = path = None
+    if LLM_CACHE:
+        blob = orjson.dumps([OPENAI_MODEL, messages, max_tokens, "json_object"], option=orjson.OPT_SORT_KEYS)
+        key = hashlib.sha256(blob).hexdigest()
+        path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+        if not refresh:
+            try:
+                if os.path.getmtime(path) + LLM_CACHE_TTL > time.time():
+                    return _read_json(path)["content"]
+            except (OSError, ValueError, KeyError):
+                pass
+    body = dict(
         model=OPENAI_MODEL,
         response_format={"type":"json_object"},
-        messages=[{"role":"system","content":system_prompt},{"role":"user","content":user_payload}],
+        messages=messages,
         temperature=0.25,
-        max_tokens=2200,
+        max_tokens=max_tokens,
     )
-    raw = resp.choices[0].message.content or "{}"
+    if BATCH_MODE:
+        raw, finish = batch_chat_text(body)
+    else:
+        # Stream so long generations never sit idle against the read timeout;
+        # the reply is only usable once complete, so just accumulate deltas.
+        buf: List[str] = []
+        finish = None
+        for chunk in _llm().chat.completions.create(stream=True, **body):
+            if chunk.choices:
+                if chunk.choices[0].delta.content:
+                    buf.append(chunk.choices[0].delta.content)
+                finish = chunk.choices[0].finish_reason or finish
+        raw = "".join(buf) or "{}"
+    # a reply cut off at max_tokens or that parses to nothing deserves another try
+    if path and finish != "length" and parse_json(raw):
+        try:
+            _write_json_atomic(path, {"content": raw})
+        except OSError:
+            pass
+        _maybe_prune(LLM_CACHE_DIR, LLM_CACHE_TTL)
+    return raw
+
+_JSON_DECODER = json.JSONDecoder()
+
+def parse_json(raw: str) -> dict:
+    """
+    Decodes a model reply (orjson). Malformed output (prose around the object,
+    trailing commas, missing closers) is repaired locally with json_repair
+    rather than spending another API round-trip.
+    """
     try:
-        return json.loads(raw)
-    except Exception:
-        start, end = raw.find("{"), raw.rfind("}")
-        return json.loads(raw[start:end+1]) if start>=0 and end>=0 else {}
+        obj = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        try:
+            # common case: a valid object wrapped in prose or a ```json fence
+            obj, _ = _JSON_DECODER.raw_decode(raw, raw.index("{"))
+        except ValueError:
+            obj = json_repair.loads(raw)
+    return obj if isinstance(obj, dict) else {}
+
+def gpt_json(system_prompt: str, user_payload: List[dict], max_tokens: int = 2200,
+             refresh: bool = False) -> dict:
+    raw = chat_text([{"role":"system","content":system_prompt},{"role":"user","content":user_payload}],
+                    max_tokens=max_tokens, refresh=refresh)
+    return parse_json(raw)
 
 # ───────────── Main builder ─────────────
-def build_case_json(youtube_url: str, provided_transcript: Optional[str]) -> dict:
+def build_case_json(youtube_url: str, provided_transcript: Optional[str], refresh: bool = False) -> dict:
     vid = video_id_from_url(youtube_url)
-    meta = fetch_basic_metadata(vid)
-    title = meta.get("title") or "Untitled Spot"
-    channel = meta.get("author") or "Unknown Channel"
     transcript = (provided_transcript or "").strip()
-    if not transcript:
-        transcript = fetch_transcript_text(vid)
+    # The transcript needs only the id; frames and trade search need the title.
+    # Everything after oembed is independent, so it all runs side by side.
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        fut_meta = ex.submit(fetch_basic_metadata, vid, refresh=refresh)
+        fut_trs = None if transcript else ex.submit(fetch_transcript_text, vid, refresh=refresh)
+        meta = fut_meta.result()
+        title = meta.get("title") or "Untitled Spot"
+        channel = meta.get("author") or "Unknown Channel"
+        case_id = safe_token(f"{title}_{vid}")[:120]
 
-    case_id = safe_token(f"{title}_{vid}")[:120]
+        # 1) Extract frames (2fps, <=16 stills)
+        fut_frames = ex.submit(extract_frames, youtube_url, case_id, fps=2.0, max_frames=16, refresh=refresh)
+        # 2) Optional lightweight trade press (small snippets); without a search key
+        #    or a real title there is nothing useful to look up
+        fut_trade = None
+        if (BING_SEARCH_KEY or SERPAPI_KEY) and meta.get("title"):
+            fut_trade = ex.submit(enrich_from_trades_for_prompt, title, refresh=refresh)
 
-    # 1) Extract frames (2fps, <=16 stills), serve as URLs
-    _ = extract_frames(youtube_url, case_id, fps=2.0, max_frames=16)
-    frame_urls = frame_urls_for_case(case_id)
+        if fut_trs is not None:
+            transcript = fut_trs.result()
+        fut_frames.result()
+        trade = {}
+        if fut_trade is not None:
+            try:
+                trade = fut_trade.result()
+            except Exception:  # enrichment handles its own I/O errors; anything here is a bug
+                app.logger.exception("trade enrichment failed for %s", vid)
+                trade = {}
 
-    # 2) Optional lightweight trade press (small snippets)
-    trade = enrich_from_trades_for_prompt(title)
+    # frame URLs need the request context, so build them back on this thread
+    frame_urls = frame_urls_for_case(case_id)
     trade_snips = trade.get("snippets", [])
     trade_urls  = trade.get("citations", [])
 
     # 3) First pass JSON
     payload = vision_payload(frame_urls, title, channel, youtube_url, transcript, trade_snips, trade_urls)
-    data = gpt_json(SOURCE_PRIORITY_PROMPT, payload)
+    data = gpt_json(SOURCE_PRIORITY_PROMPT, payload, refresh=refresh)
 
     # 4) Post-validate & concrete enforcement for visuals_montage_sourced
     data.setdefault("meta", {}).update({"title": title, "channel": channel, "url": youtube_url})
     data.setdefault("visuals_montage_sourced", [])
     concrete = drop_vague(data["visuals_montage_sourced"])
 
-    # If too vague or empty but frames exist, run one rewrite pass with stricter instruction
+    # The prompt already self-checks these rules; the rewrite pass is a last resort
     if len(concrete) < 6 and len(frame_urls) > 0:
-        tighten = """
-Return ONLY JSON with the same keys. Your 'visuals_montage_sourced' is too vague.
-Rewrite it to list 8–14 concrete on-screen actions that are visible in the provided frames.
-Each item must include a specific subject + strong verb + object (e.g., “woman crashes through window”, “dog howls”, “man upends coffee table”).
-Do NOT use generic words like “people/family/friends react”.
-"""
-        resp2 = _llm().chat.completions.create(
-            model=OPENAI_MODEL,
-            response_format={"type":"json_object"},
-            messages=[
-                {"role":"system","content":SOURCE_PRIORITY_PROMPT},
-                {"role":"user","content":payload},
-                {"role":"user","content":tighten}
-            ],
-            temperature=0.25,
-            max_tokens=2200,
-        )
-        raw2 = resp2.choices[0].message.content or "{}"
+        raw2 = chat_text([
+            {"role":"system","content":SOURCE_PRIORITY_PROMPT},
+            {"role":"user","content":payload},
+            {"role":"user","content":TIGHTEN_PROMPT}
+        ], max_tokens=TIGHTEN_MAX_TOKENS, refresh=refresh)
         try:
-            cand = json.loads(raw2)
-            concrete = drop_vague((cand or {}).get("visuals_montage_sourced", []))
-            if concrete:
-                data["visuals_montage_sourced"] = concrete
-        except Exception:
+            cand = drop_vague(parse_json(raw2).get("visuals_montage_sourced", []))
+            # only adopt the rewrite if it actually improved on the first pass
+            if len(cand) > len(concrete):
+                concrete = cand
+        except (AttributeError, TypeError):  # rewrite came back in an unexpected shape
             pass
-    else:
-        data["visuals_montage_sourced"] = concrete
+    data["visuals_montage_sourced"] = concrete
 
     # Ensure sources present (merge trade urls if any)
-    if "sources" not in data or not isinstance(data["sources"], list):
-        data["sources"] = []
-    for u in trade_urls:
-        if u not in data["sources"]:
-            data["sources"].append(u)
+    sources = data.get("sources")
+    if not isinstance(sources, list):
+        sources = []
+    # set lookup instead of a list scan per url; trade_urls is already de-duplicated
+    seen = {s for s in sources if isinstance(s, str)}
+    data["sources"] = sources + [u for u in trade_urls if u not in seen]
 
     data["id"] = case_id
     return data
@@ -449,6 +923,9 @@ INDEX_HTML = """
             <option value="pdf">.pdf (JSON pretty-printed)</option>
           </select>
         </div>
+        <div>
+          <label><input type="checkbox" name="refresh" value="1"> Bypass cache (re-fetch metadata, transcript, frames, trade press)</label>
+        </div>
       </div>
       <p style="margin-top:14px"><button class="btn" type="submit">Generate</button></p>
     </form>
@@ -485,46 +962,126 @@ SUCCESS_HTML = """
 </html>
 """
 
-PDF_WRAPPER = Template("""
+PENDING_HTML = """
 <!doctype html>
 <html>
 <head>
   <meta charset="utf-8" />
-  <title>{{ title }}</title>
+  <meta name="viewport" content="width=device-width, initial-scale=1" />
+  <meta http-equiv="refresh" content="3;url={{ job_url }}" />
+  <title>Working…</title>
   <style>
-    body { font: 12pt/1.55 -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Arial, sans-serif; color:#111; margin: 28px; }
-    h1 { font-size: 18pt; margin: 0 0 12px; }
-    pre { padding: 14px; border: 1px solid #e5e7eb; border-radius: 10px; background: #f9fafb; white-space: pre-wrap; word-break: break-word; }
-    .meta { color:#555; font-size:10pt; margin-bottom: 16px; }
+    body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Arial, sans-serif; color:#111; margin: 24px; }
+    .card { max-width: 860px; margin: 0 auto; border: 1px solid #e5e7eb; border-radius: 14px; padding: 20px; box-shadow: 0 6px 20px rgba(0,0,0,.05); text-align: center; }
+    .muted { color:#6b7280; font-size: 13px; }
   </style>
 </head>
 <body>
-  <h1>{{ heading }}</h1>
-  <div class="meta">{{ url }}</div>
-  <pre>{{ json_text }}</pre>
+  <div class="card">
+    <h2>Generating…</h2>
+    <p>Sampling frames and drafting the JSON. This page refreshes until the file is ready.</p>
+    <p class="muted">Job <code>{{ job_id }}</code> · <a href="{{ job_url }}">check now</a></p>
+  </div>
+</body>
+</html>
+"""
+
+PDF_CSS = """
+body { font: 12pt/1.55 -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Arial, sans-serif; color:#111; margin: 28px; }
+h1 { font-size: 18pt; margin: 0 0 12px; }
+pre { padding: 14px; border: 1px solid #e5e7eb; border-radius: 10px; background: #f9fafb; white-space: pre-wrap; word-break: break-word; }
+.meta { color:#555; font-size:10pt; margin-bottom: 16px; }
+"""
+
+# CPU-bound layout/rasterisation runs outside the request thread (and the GIL).
+# "spawn" keeps children clear of locks held by gunicorn's worker threads.
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+_PDF_POOL_LOCK = threading.Lock()
+
+def _new_pdf_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+PDF_POOL = _new_pdf_pool()
+
+@functools.lru_cache(maxsize=1)
+def _weasy():
+    """
+    Imports WeasyPrint and parses PDF_CSS once per PDF worker process. The web
+    process never renders, so it never pays the cairo/pango import.
+    """
+    try:
+        from weasyprint import HTML, CSS
+        from weasyprint.text.fonts import FontConfiguration
+    except (ImportError, OSError) as e:
+        raise RuntimeError("PDF output needs WeasyPrint and its system libraries (cairo, pango).") from e
+    fonts = FontConfiguration()
+    return HTML, CSS(string=PDF_CSS, font_config=fonts), fonts
+
+def _render_pdf(html_doc: str) -> bytes:
+    weasy_html, stylesheet, fonts = _weasy()
+    return weasy_html(string=html_doc, base_url=".").write_pdf(stylesheets=[stylesheet], font_config=fonts)
+
+# Compiled once at import (render_template_string re-parses its source on every call)
+_TEMPLATES = Environment(loader=DictLoader({"index": INDEX_HTML, "success": SUCCESS_HTML, "pending": PENDING_HTML}),
+                         autoescape=True, auto_reload=False)
+SUCCESS_TMPL = _TEMPLATES.get_template("success")
+PENDING_TMPL = _TEMPLATES.get_template("pending")
+INDEX_PAGE = _TEMPLATES.get_template("index").render()  # no variables: render once
+
+def render_pdf_html(title: str, heading: str, url: str, json_text: str) -> str:
+    """Fixed PDF page; a plain f-string skips Jinja's render machinery. All inputs are escaped here."""
+    e = html.escape
+    return f"""
+<!doctype html>
+<html>
+<head>
+  <meta charset="utf-8" />
+  <title>{e(title)}</title>
+</head>
+<body>
+  <h1>{e(heading)}</h1>
+  <div class="meta">{e(url)}</div>
+  <pre>{e(json_text)}</pre>
 </body>
 </html>
-""")
+"""
 
 # ───────────── Writers ─────────────
+def _pdf_bytes(html_doc: str) -> bytes:
+    """
+    Renders in PDF_POOL. A child that dies (cairo segfault, OOM kill) breaks the
+    whole pool, so the first caller to see that swaps in a fresh one and retries once.
+    """
+    global PDF_POOL
+    pool = PDF_POOL
+    try:
+        return pool.submit(_render_pdf, html_doc).result()
+    except BrokenProcessPool:
+        with _PDF_POOL_LOCK:
+            if PDF_POOL is pool:
+                PDF_POOL = _new_pdf_pool()
+                pool.shutdown(wait=False)
+            pool = PDF_POOL
+        return pool.submit(_render_pdf, html_doc).result()
+
 def write_json_file(data: dict, fmt: str) -> Tuple[str, str]:
     file_id = data.get("id") or safe_token("case_study")
-    pretty = json.dumps(data, ensure_ascii=False, indent=2)
+    # orjson emits UTF-8 bytes directly: no ensure_ascii pass, no separate encode
+    pretty = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
     if fmt == "pdf":
-        from weasyprint import HTML as WEASY_HTML
-        html_doc = PDF_WRAPPER.render(
+        html_doc = render_pdf_html(
             title=file_id,
             heading=data.get("meta",{}).get("title", file_id),
             url=data.get("meta",{}).get("url",""),
-            json_text=html.escape(pretty),
+            json_text=pretty.decode("utf-8"),
         )
         outp = os.path.join(OUT_DIR, f"{file_id}.pdf")
-        WEASY_HTML(string=html_doc, base_url=".").write_pdf(outp)
+        # rendered bytes come back from the worker; a reader never sees a half-written file
+        _write_bytes_atomic(outp, _pdf_bytes(html_doc))
         return outp, f"{file_id}.pdf"
     else:
         outp = os.path.join(OUT_DIR, f"{file_id}.txt")
-        with open(outp, "w", encoding="utf-8") as f:
-            f.write(pretty)
+        _write_bytes_atomic(outp, pretty)
         return outp, f"{file_id}.txt"
 
 # ─────────────────────── Routes ────────────────────────
@@ -534,36 +1091,148 @@ def health():
 
 @app.get("/")
 def index():
-    return render_template_string(INDEX_HTML)
+    return INDEX_PAGE
 
 @app.get("/out/<path:filename>")
 def get_file(filename):
+    # raises NotFound (404) itself for missing files and paths outside OUT_DIR
+    return send_from_directory(OUT_DIR, filename, as_attachment=True)
+
+# ───────────── Background jobs ─────────────
+_JOBS_POOL = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+_JOB_ID_RE = re.compile(r"[0-9a-f]{32}")
+# A job still "running" after this long lost its worker (restart, redeploy, OOM):
+# two frame steps plus ~15 minutes for the completions and their retries, or up to
+# two full Batch API waits (draft + rewrite) under BATCH_MODE
+JOB_MAX_AGE = float(os.getenv("JOB_MAX_AGE", str(2 * FRAME_STEP_TIMEOUT + 900
+                                                 + (2 * BATCH_MAX_WAIT if BATCH_MODE else 0))))
+# The pool is in memory, so a restart drops queued jobs too. A full queue drains in at
+# most ceil(JOB_MAX_PENDING / JOB_WORKERS) rounds of JOB_MAX_AGE; a job queued longer
+# than that was lost, not merely waiting behind a backlog.
+JOB_QUEUE_MAX_AGE = float(os.getenv("JOB_QUEUE_MAX_AGE",
+                                    str(-(-JOB_MAX_PENDING // JOB_WORKERS) * JOB_MAX_AGE)))
+JOB_TTL = float(os.getenv("JOB_TTL", "86400"))  # status files older than this are pruned
+# Each queued job pins its request context (pasted transcript included) until it runs
+_pending_jobs = 0
+_pending_lock = threading.Lock()
+
+def _reserve_jobs(n: int) -> bool:
+    """Claims n pending-job slots in this process, all or none."""
+    global _pending_jobs
+    with _pending_lock:
+        if _pending_jobs + n > JOB_MAX_PENDING:
+            return False
+        _pending_jobs += n
+        return True
+
+def _release_job(n: int = 1) -> None:
+    global _pending_jobs
+    with _pending_lock:
+        _pending_jobs -= n
+
+def _busy_response(as_json: bool):
+    msg = "Too many jobs in progress. Please try again shortly."
+    headers = {"Retry-After": str(JOB_RETRY_AFTER)}
+    if as_json:
+        return jsonify({"error": msg}), 503, headers
+    return f"<pre>{msg}</pre>", 503, headers
+
+def _job_path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def _run_job(job_id: str, url: str, transcript_text: str, fmt: str, refresh: bool) -> None:
+    status = {"status": "error", "error": "Job stopped unexpectedly."}
     try:
-        return send_from_directory(OUT_DIR, filename, as_attachment=True)
-    except Exception:
-        abort(404)
+        # JOB_MAX_AGE counts from here; waiting in the pool is bounded by JOB_QUEUE_MAX_AGE
+        _write_json_atomic(_job_path(job_id), {"status": "running", "started_at": time.time()})
+        data = build_case_json(url, provided_transcript=transcript_text or None, refresh=refresh)
+        _, file_name = write_json_file(data, fmt)
+        status = {"status": "done", "file_url": f"/out/{file_name}", "file_name": file_name}
+    except Exception as e:
+        app.logger.exception("job %s failed", job_id)
+        status = {"status": "error", "error": str(e)}
+    finally:
+        try:
+            _write_json_atomic(_job_path(job_id), status)
+        except OSError:
+            pass  # the poll reports the job as lost once JOB_MAX_AGE passes
+        _release_job()
+
+def _queue_job(url: str, transcript_text: str, fmt: str, refresh: bool) -> str:
+    # callers claim the slot first with _reserve_jobs; _run_job gives it back
+    _prune_dir(JOBS_DIR, JOB_TTL)
+    job_id = uuid.uuid4().hex
+    _write_json_atomic(_job_path(job_id), {"status": "queued", "queued_at": time.time()})
+    # the copied request context outlives this response (frame URLs need url_for)
+    _JOBS_POOL.submit(copy_current_request_context(_run_job), job_id, url, transcript_text, fmt, refresh)
+    return job_id
 
 @app.post("/generate")
 def generate():
+    """Queues the build and answers 202 at once; the page polls /jobs/<id>."""
     url = (request.form.get("url") or "").strip()
     transcript_text = (request.form.get("transcript") or "").strip()
     fmt = (request.form.get("format") or "txt").strip().lower()
     if fmt not in ("txt","pdf"): fmt = "txt"
+    refresh = bool(request.form.get("refresh"))
+    if not _reserve_jobs(1):
+        return _busy_response(as_json=False)
     try:
-        data = build_case_json(url, provided_transcript=transcript_text or None)
-        abs_path, file_name = write_json_file(data, fmt)
-        return render_template_string(
-            SUCCESS_HTML,
-            file_url=f"/out/{file_name}",
-            file_name=file_name,
-        )
-    except Exception as e:
-        try:
-            with open(os.path.join(OUT_DIR, "last_error.txt"), "w", encoding="utf-8") as f:
-                f.write("Error: " + str(e))
-        except Exception:
-            pass
-        return f"<pre>Error generating JSON:\n{e}\nSee /out/last_error.txt</pre>", 400
+        job_id = _queue_job(url, transcript_text, fmt, refresh)
+    except BaseException:
+        _release_job()  # never reached the pool, so _run_job won't give the slot back
+        raise
+    job_url = url_for("job_status", job_id=job_id)
+    return PENDING_TMPL.render(job_id=job_id, job_url=job_url), 202, {"Location": job_url}
+
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    if not _JOB_ID_RE.fullmatch(job_id):
+        abort(404)
+    try:
+        status = _read_json(_job_path(job_id))
+    except (OSError, ValueError):
+        abort(404)
+    now = time.time()
+    if (status.get("status") == "running" and now - status.get("started_at", 0) > JOB_MAX_AGE
+            or status.get("status") == "queued" and now - status.get("queued_at", 0) > JOB_QUEUE_MAX_AGE):
+        status = {"status": "error", "error": "Job did not finish (the worker may have restarted). Please try again."}
+    if request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json":
+        code = {"done": 200, "error": 400}.get(status.get("status"), 202)
+        return jsonify(status), code
+    if status.get("status") == "done":
+        return SUCCESS_TMPL.render(file_url=status["file_url"], file_name=status["file_name"])
+    if status.get("status") == "error":
+        return f"<pre>Error generating JSON:\n{html.escape(status.get('error', ''))}</pre>", 400
+    job_url = url_for("job_status", job_id=job_id)
+    return PENDING_TMPL.render(job_id=job_id, job_url=job_url), 202
+
+@app.post("/generate_batch")
+def generate_batch():
+    """JSON body {"urls": [...], "format": "txt"|"pdf"}; queues one job per URL and answers 202."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("urls"), list):
+        return jsonify({"error": "Provide a non-empty 'urls' list."}), 400
+    urls = [u.strip() for u in body["urls"] if isinstance(u, str) and u.strip()]
+    fmt = str(body.get("format") or "txt").strip().lower()
+    if fmt not in ("txt","pdf"): fmt = "txt"
+    if not urls:
+        return jsonify({"error": "Provide a non-empty 'urls' list."}), 400
+    if len(urls) > BATCH_MAX_URLS:
+        return jsonify({"error": f"At most {BATCH_MAX_URLS} URLs per batch."}), 400
+    if not _reserve_jobs(len(urls)):  # whole batch or nothing
+        return _busy_response(as_json=True)
+    jobs = []
+    try:
+        for u in urls:
+            job_id = _queue_job(u, "", fmt, False)
+            jobs.append({"url": u, "job_id": job_id, "job_url": url_for("job_status", job_id=job_id)})
+    except BaseException:
+        _release_job(len(urls) - len(jobs))  # slots of the URLs that never reached the pool
+        raise
+    return jsonify({"jobs": jobs}), 202
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8080")), debug=True)
+    # local dev server only; deploys run gunicorn (see Dockerfile/Procfile)
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8080")),
+            debug=os.getenv("FLASK_DEBUG", "") == "1", threaded=True)